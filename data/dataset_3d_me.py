@@ -7,7 +7,7 @@ import pandas as pd
 import numpy as np
 from torch.utils.data import Dataset
 from geotnf.transformation import GeometricTnf
-from pythonME.me_handler import MEHandler
+from pythonME.me_handler import create_me_handler
 
 class Dataset3DME(Dataset):
     
@@ -39,7 +39,7 @@ class Dataset3DME(Dataset):
             self.img_L_names = self.pairs.iloc[:,0]
             self.img_R_names = self.pairs.iloc[:,1]
             self.affine_simple_values = self.pairs.iloc[:, 2:].values.astype('float')
-            self.me_handler = MEHandler(h_cropped, w_cropped, loss_metric='colorindependent', runs_to_warm_up=1)
+            self.me_handler = create_me_handler(h_cropped, w_cropped, loss_metric='colorindependent', runs_to_warm_up=1)
             self.crop = crop
         else:
             self.mv_names = self.pairs.iloc[:,0]
@@ -8,11 +8,12 @@ import pandas as pd
 import numpy as np
 try:
     import cv2
-    from pythonME.me_handler import MEHandler
+    from pythonME.me_handler import create_me_handler
 except:
     print("Modules cv2, pyME are not loaded: warping or ME on training may not work")
     pass
 from torch.utils.data import Dataset
+from util.torch_util import mv_to_int16
 from geotnf.transformation import GeometricTnf
 from torch.autograd import Variable
 from geotnf.transformation import homography_mat_from_4_pts
@@ -42,30 +43,42 @@ class Warper(object):
         self.W = W
         self.H_off = int(H * crop) // 2
         self.W_off = int(W * crop) // 2
-
-        tx = (2 * np.random.rand(1) - 1) * 0.1 * self.W # between -0.1*W and 0.1*W
-        if np.random.randint(0, 5) == 4:
-            # 25% of pairs are set to identity transform with disparity
+        # explicit end bounds: img[0:-0] would be empty for crop == 0
+        self.crop_slice = (slice(self.H_off, H - self.H_off), slice(self.W_off, W - self.W_off))
+
+        # draw all random parameters at once
+        r = np.random.rand(5)
+        tx = (2 * r[0] - 1) * 0.1 * self.W # between -0.1*W and 0.1*W
+        if r[1] < 0.2:
+            # 20% of pairs are set to identity transform with disparity
             self.mat = np.array([[1.0, 0.0, tx], [0.0, 1.0, 0.0]], dtype=np.float32)
-            self.theta = np.array([0.0, 1.0, 0.0, tx / self.W])
+            self.theta = np.array([0.0, 1.0, 0.0, tx / self.W], dtype=np.float32)
         else:
-            rotate_value = (np.random.rand() - 0.5) * 2 * 0.75 # between -0.75 and 0.75. means angle, not radians
-            scale_value = 1 + (np.random.rand() - 0.5) * 2 * 0.015 # between 0.985 and 1.015
-            shift_value = (np.random.rand() - 0.5) * 2 * 10 # between -10 and 10. means pixels
-            self.mat = cv2.getRotationMatrix2D((W//2, H//2), rotate_value, scale_value)
+            rotate_value = (r[2] - 0.5) * 1.5 # between -0.75 and 0.75. means angle, not radians
+            scale_value = 1 + (r[3] - 0.5) * 0.03 # between 0.985 and 1.015
+            shift_value = (r[4] - 0.5) * 20 # between -10 and 10. means pixels
+            self.mat = cv2.getRotationMatrix2D((W >> 1, H >> 1), rotate_value, scale_value)
             self.mat[1,2] += shift_value
             self.mat[0,2] += tx
-            self.theta = np.array([rotate_value, scale_value, shift_value / self.H, tx / self.W])
+            self.mat = self.mat.astype(np.float32, copy=False)
+            self.theta = np.array([rotate_value, scale_value, shift_value / self.H, tx / self.W], dtype=np.float32)
         
         if not self.add_tx:
             self.mat[0,2] -= tx
             self.theta = self.theta[:3]
+
+        # fold the crop into the warp so the discarded border is never computed
+        self.mat_crop = self.mat.copy()
+        self.mat_crop[0,2] -= self.W_off
+        self.mat_crop[1,2] -= self.H_off
+        self.dsize_crop = (self.W - 2 * self.W_off, self.H - 2 * self.H_off)
     
     def crop(self, img):
-        return img[self.H_off:-self.H_off, self.W_off:-self.W_off]
+        return img[self.crop_slice]
     
     def warp(self, img_L, img_R):
-        return self.crop(img_L), self.crop(cv2.warpAffine(img_R, self.mat, dsize = (self.W, self.H)))
+        return self.crop(img_L), cv2.warpAffine(img_R, self.mat_crop, dsize = self.dsize_crop,
+                                                 flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
         
     def get_theta(self):
         return self.theta
@@ -83,6 +96,9 @@ class MEDataset(Dataset):
             dataset_image_path (string): Directory with all the images.
             h, w (int): size of input images for ME initialization.
             crop (float): crop factor after image warping.
+            quantize_mv (bool): return mv_L2R/mv_R2L as int16 in 1/4 pel units to halve transfer size
+                                (lossy for non-pyME vectors, which are rounded to 1/4 pel;
+                                restore with BatchTensorToVars(mv_scale=MV_QUANT_SCALE)).
             
     Returns:
             Dict: {
@@ -103,8 +119,11 @@ class MEDataset(Dataset):
                  use_random_patch,
                  normalize_inputs,
                  geometric_model='affine_simple_4', 
-                 random_sample=True):
+                 random_sample=True,
+                 quantize_mv=False):
     
+        if quantize_mv and normalize_inputs:
+            raise ValueError('quantize_mv can not be used with normalize_inputs (normalized MVs are not in pels)')
         # read csv file
         self.csv = pd.read_csv(os.path.join(dataset_csv_path, dataset_csv_file))
         self.random_sample = random_sample
@@ -130,13 +149,14 @@ class MEDataset(Dataset):
             if not self.random_sample:
                 self.img_R_names = self.csv.iloc[:,1]
                 self.theta = self.csv.iloc[:, 2:].values.astype('float')
-            self.me_handler = MEHandler(h_cropped, w_cropped, loss_metric='colorindependent', runs_to_warm_up=1)
+            self.me_handler = create_me_handler(h_cropped, w_cropped, loss_metric='colorindependent', runs_to_warm_up=1)
 
         # copy args
         self.dataset_path = dataset_image_path
         self.geometric_model = geometric_model
         self.use_conf = use_conf
         self.crop = crop
+        self.quantize_mv = quantize_mv
 
     def __len__(self):
         return len(self.csv)
@@ -163,7 +183,7 @@ class MEDataset(Dataset):
                 # Warp with random transformations
                 h, w, _ = image_L.shape
                 warper = Warper(h, w, geometric_model=self.geometric_model, crop=self.crop)
-                image_L, image_R = warper.warp(image_L, image_L.copy())
+                image_L, image_R = warper.warp(image_L, image_L)
                 theta = warper.get_theta()
             else:
                 image_R = io.imread(os.path.join(self.dataset_path, self.img_R_names[idx]))
@@ -188,8 +208,12 @@ class MEDataset(Dataset):
         # make arrays float tensor for subsequent processing
         grid_L2R = torch.Tensor((grid + mv_L2R).astype(np.float32))
         grid_R2L = torch.Tensor((grid + mv_R2L).astype(np.float32))
-        mv_L2R = torch.Tensor(mv_L2R.astype(np.float32))
-        mv_R2L = torch.Tensor(mv_R2L.astype(np.float32))
+        if self.quantize_mv:
+            mv_L2R = torch.from_numpy(mv_to_int16(mv_L2R))
+            mv_R2L = torch.from_numpy(mv_to_int16(mv_R2L))
+        else:
+            mv_L2R = torch.Tensor(mv_L2R.astype(np.float32))
+            mv_R2L = torch.Tensor(mv_R2L.astype(np.float32))
         grid = torch.Tensor(grid)
         theta = torch.Tensor(theta.astype(np.float32))
 
@@ -2,15 +2,18 @@ from __future__ import print_function, division
 import torch
 import os
 from os.path import exists, join, basename
-from skimage import io
 import pandas as pd
 import numpy as np
 import cv2
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from geotnf.transformation import GeometricTnf
 from torch.autograd import Variable
 from geotnf.transformation import homography_mat_from_4_pts
-from pythonME.me_handler import MEHandler
+from pythonME.me_handler import create_me_handler
+from util.torch_util import mv_to_int16
+
+cv2.setUseOptimized(True)
 
 class Warper(object):
     def __init__(self, H, W, geometric_model='affine_simple_4', crop=0.2):
@@ -25,30 +28,43 @@ class Warper(object):
         self.W = W
         self.H_off = int(H * crop) // 2
         self.W_off = int(W * crop) // 2
+        # explicit end bounds: img[0:-0] would be empty for crop == 0
+        self.crop_slice = (slice(self.H_off, H - self.H_off), slice(self.W_off, W - self.W_off))
 
-        tx = (2 * np.random.rand(1) - 1) * 0.1 * self.W # between -0.1*W and 0.1*W
-        if np.random.randint(0, 5) == 4:
-            # 25% of pairs are set to identity transform with disparity
+        # draw all random parameters at once
+        r = np.random.rand(5)
+        tx = (2 * r[0] - 1) * 0.1 * self.W # between -0.1*W and 0.1*W
+        if r[1] < 0.2:
+            # 20% of pairs are set to identity transform with disparity
             self.mat = np.array([[1.0, 0.0, tx], [0.0, 1.0, 0.0]], dtype=np.float32)
-            self.theta = np.array([0.0, 1.0, 0.0, tx / self.W])
+            self.theta = np.array([0.0, 1.0, 0.0, tx / self.W], dtype=np.float32)
         else:
-            rotate_value = (np.random.rand() - 0.5) * 2 * 0.75 # between -0.75 and 0.75
-            scale_value = 1 + (np.random.rand() - 0.5) * 2 * 0.015 # between 0.985 and 1.015
-            shift_value = (np.random.rand() - 0.5) * 2 * 10 # between -10 and 10
-            self.mat = cv2.getRotationMatrix2D((W//2, H//2), rotate_value, scale_value)
+            rotate_value = (r[2] - 0.5) * 1.5 # between -0.75 and 0.75
+            scale_value = 1 + (r[3] - 0.5) * 0.03 # between 0.985 and 1.015
+            shift_value = (r[4] - 0.5) * 20 # between -10 and 10
+            self.mat = cv2.getRotationMatrix2D((W >> 1, H >> 1), rotate_value, scale_value)
             self.mat[1,2] += shift_value
             self.mat[0,2] += tx
-            self.theta = np.array([rotate_value, scale_value, shift_value / self.H, tx / self.W])
+            self.mat = self.mat.astype(np.float32, copy=False)
+            self.theta = np.array([rotate_value, scale_value, shift_value / self.H, tx / self.W], dtype=np.float32)
         
         if not self.add_tx:
             self.mat[0, 2] = 0.0
             self.theta = self.theta[:3]
+
+        # fold the crop into the warp so the discarded border is never computed
+        self.mat_crop = self.mat.copy()
+        self.mat_crop[0,2] -= self.W_off
+        self.mat_crop[1,2] -= self.H_off
+        self.dsize_crop = (self.W - 2 * self.W_off, self.H - 2 * self.H_off)
     
     def crop(self, img):
-        return img[self.H_off:-self.H_off, self.W_off:-self.W_off]
+        return img[self.crop_slice]
     
-    def warp(self, img_L, img_R):
-        return self.crop(img_L), self.crop(cv2.warpAffine(img_R, self.mat, dsize = (self.W, self.H)))
+    def warp(self, img_L, img_R, dst=None):
+        # dst: optional output buffer for the right view, reallocated by cv2 if its shape does not match
+        return self.crop(img_L), cv2.warpAffine(img_R, self.mat_crop, dsize = self.dsize_crop, dst=dst,
+                                                 flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
         
     def get_theta(self):
         return self.theta
@@ -65,6 +81,12 @@ class SynthDatasetME(Dataset):
             dataset_image_path (string): Directory with all the images.
             h, w (int): size of input images for ME initialization.
             crop (float): crop factor after image warping.
+            cache_dir (string): Directory with images pre-decoded to .npy by prepare_cache.py (optional).
+            quantize_mv (bool): return Motion Vectors as int16 in 1/4 pel units to halve transfer size
+                                (lossy for non-pyME vectors, which are rounded to 1/4 pel;
+                                restore with BatchTensorToVars(mv_scale=MV_QUANT_SCALE)).
+            samples_per_image (int): number of random pairs warped from each decoded image (random_sample only).
+                                     If > 1, every value gets a leading K dim; use flatten_samples_collate in DataLoader.
             
     Returns:
             Dict: {
@@ -83,7 +105,10 @@ class SynthDatasetME(Dataset):
                  crop,
                  use_conf,
                  geometric_model='affine_simple_4', 
-                 random_sample=True):
+                 random_sample=True,
+                 cache_dir=None,
+                 quantize_mv=False,
+                 samples_per_image=1):
     
         # read csv file
         self.train_data = pd.read_csv(os.path.join(dataset_csv_path,dataset_csv_file))
@@ -95,13 +120,22 @@ class SynthDatasetME(Dataset):
         if self.random_sample==False:
             self.theta_array = self.train_data.iloc[:, 1:].values.astype('float')
         else:
-            self.me_handler = MEHandler(h_cropped, w_cropped, loss_metric='colorindependent', runs_to_warm_up=1)
+            # ME is created lazily on first use, i.e. once inside each DataLoader worker process
+            self.me_args = (h_cropped, w_cropped, 'colorindependent', 1)
+            self.me_handler = None
             self.crop = crop
+            # per-worker buffer for the warped right view, reused across samples
+            self.warp_buf = None
         
         self.grid = np.stack(np.indices((h_cropped, w_cropped), dtype=np.float32)[::-1], axis=0)[..., ::4, ::4]
         # copy arguments
         self.dataset_image_path = dataset_image_path
         self.geometric_model = geometric_model
+        self.cache_dir = cache_dir
+        self.quantize_mv = quantize_mv
+        if samples_per_image > 1 and not self.random_sample:
+            raise ValueError('samples_per_image > 1 is only supported with random_sample')
+        self.samples_per_image = samples_per_image
         
     def __len__(self):
         return len(self.train_data)
@@ -110,18 +144,37 @@ class SynthDatasetME(Dataset):
         if self.random_sample:
             if self.use_conf:
                 raise NotImplementedError('Calculating confidence in synth dataset has not implemented yet')
-            # read image
-            img_name = os.path.join(self.dataset_image_path, self.img_names[idx])
-            image_L = io.imread(img_name)
+            # read image (memory-mapped if pre-decoded, so only the pixels used by warping/crop are read)
+            if self.cache_dir is not None:
+                image_L = np.load(os.path.join(self.cache_dir, self.img_names[idx] + '.npy'), mmap_mode='r')
+            else:
+                img_name = os.path.join(self.dataset_image_path, self.img_names[idx])
+                image_L = cv2.imread(img_name, cv2.IMREAD_COLOR)
+                if image_L is None:
+                    raise IOError('Can not read image %s' % img_name)
+                image_L = cv2.cvtColor(image_L, cv2.COLOR_BGR2RGB)
+
+            if self.me_handler is None:
+                self.me_handler = create_me_handler(*self.me_args)
 
-            # Warp with random transformations
+            # Warp with random transformations (samples_per_image pairs from one decoded image)
             h, w, _ = image_L.shape
-            warper = Warper(h, w, geometric_model=self.geometric_model, crop=self.crop)
-            image_L, image_R = warper.warp(image_L, image_L.copy())
-            theta = warper.get_theta()
+            mv_L2R, mv_R2L, theta = [], [], []
+            for _ in range(self.samples_per_image):
+                warper = Warper(h, w, geometric_model=self.geometric_model, crop=self.crop)
+                image_L_cropped, image_R = warper.warp(image_L, image_L, dst=self.warp_buf)
+                self.warp_buf = image_R
+                theta.append(warper.get_theta())
 
-            # Calculate Motion Vectors
-            mv_L2R, mv_R2L = self.me_handler.calculate_disparity(image_L, image_R)
+                # Calculate Motion Vectors
+                l2r, r2l = self.me_handler.calculate_disparity(image_L_cropped, image_R)
+                mv_L2R.append(l2r)
+                mv_R2L.append(r2l)
+
+            if self.samples_per_image > 1:
+                mv_L2R, mv_R2L, theta = np.stack(mv_L2R), np.stack(mv_R2L), np.stack(theta)
+            else:
+                mv_L2R, mv_R2L, theta = mv_L2R[0], mv_R2L[0], theta[0]
 
             # permute order to CHW
             # mv_L2R = mv_L2R.transpose(2,0,1)
@@ -138,10 +191,16 @@ class SynthDatasetME(Dataset):
             theta = self.theta_array[idx, :]
 
         # make arrays float tensor for subsequent processing
-        mv_L2R = torch.Tensor(mv_L2R.astype(np.float32))
-        mv_R2L = torch.Tensor(mv_R2L.astype(np.float32))
+        if self.quantize_mv:
+            mv_L2R = torch.from_numpy(mv_to_int16(mv_L2R))
+            mv_R2L = torch.from_numpy(mv_to_int16(mv_R2L))
+        else:
+            mv_L2R = torch.from_numpy(np.ascontiguousarray(mv_L2R, dtype=np.float32))
+            mv_R2L = torch.from_numpy(np.ascontiguousarray(mv_R2L, dtype=np.float32))
         grid = torch.Tensor(self.grid)
-        theta = torch.Tensor(theta.astype(np.float32))
+        if self.samples_per_image > 1:
+            grid = grid.unsqueeze(0).expand(self.samples_per_image, -1, -1, -1)
+        theta = torch.from_numpy(np.ascontiguousarray(theta, dtype=np.float32))
 
         sample = {'mv_L2R': mv_L2R, 'mv_R2L': mv_R2L, 'grid': grid, 'theta_GT': theta}
         
@@ -150,3 +209,12 @@ class SynthDatasetME(Dataset):
             sample['confidence'] = conf
 
         return sample
+
+
+def flatten_samples_collate(batch):
+    """
+    DataLoader collate_fn for SynthDatasetME with samples_per_image=K > 1:
+    merges the K dim into the batch dim, so a batch of B images gives B*K pairs
+    """
+    batch = default_collate(batch)
+    return {key: value.flatten(0, 1) for key, value in batch.items()}
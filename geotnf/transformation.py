@@ -171,8 +171,8 @@ class SynthPairTnf(object):
     def __call__(self, batch):
         image_batch, theta_batch = batch['image'], batch['theta'] 
         if self.use_cuda:
-            image_batch = image_batch.cuda()
-            theta_batch = theta_batch.cuda()
+            image_batch = image_batch.cuda(non_blocking=True)
+            theta_batch = theta_batch.cuda(non_blocking=True)
             
         b, c, h, w = image_batch.size()
               
@@ -67,6 +67,7 @@ class ArgumentParser():
         # Motion Vectors confidence
         me_params.add_argument('--use-random-patch', type=str_to_bool, nargs='?', const=True, default=False, help='use random cropped patch of input instead of full')
         me_params.add_argument('--normalize-inputs', type=str_to_bool, nargs='?', const=True, default=False, help='normalize mv and grid to [-1,1]')
+        me_params.add_argument('--quantize-mv', type=str_to_bool, nargs='?', const=True, default=False, help='send mv as int16 quarter-pel values to halve transfer size (lossy for non-pyME mv, rounded to 1/4 pel)')
         
 
     def add_synth_dataset_parameters(self):
@@ -111,6 +112,7 @@ class ArgumentParser():
         train_params.add_argument('--log_dir', type=str, default='',
                         help='If unspecified log_dir will be set to'
                              '<trained_models_dir>/<trained_models_fn>/')
+        train_params.add_argument('--log-graph', type=str_to_bool, nargs='?', const=True, default=True, help='add model graph to TensorBoard')
 
     def add_eval_parameters(self):
         eval_params = self.parser.add_argument_group('eval')
@@ -0,0 +1,53 @@
+from __future__ import print_function, division
+import argparse
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+"""
+
+Script to decode dataset images once and store them as .npy files,
+so SynthDatasetME(cache_dir=...) can memory-map them instead of decoding JPEGs every epoch
+
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-decode training images to .npy cache')
+    parser.add_argument('--dataset-csv-path', type=str, default='', help='path to training transformation csv folder')
+    parser.add_argument('--dataset-csv-files', nargs='+', type=str, default=['train.csv', 'val.csv'], help='csv files with image names')
+    parser.add_argument('--dataset-image-path', type=str, default='', help='path to folder containing training images')
+    parser.add_argument('--cache-dir', type=str, default='cache', help='output folder for decoded images')
+    args = parser.parse_args()
+
+    for csv_file in args.dataset_csv_files:
+        img_names = pd.read_csv(os.path.join(args.dataset_csv_path, csv_file)).iloc[:, 0]
+        if img_names.iloc[0].endswith('.npy') or img_names.iloc[0].endswith('.npz'):
+            print('Skipping %s: it lists Motion Vector files, not images' % csv_file)
+            continue
+        skipped = []
+        for img_name in tqdm(img_names.unique(), desc=csv_file):
+            out_name = os.path.join(args.cache_dir, img_name + '.npy')
+            if os.path.exists(out_name):
+                continue
+            # same decoding as SynthDatasetME: uint8 RGB, HxWx3
+            img_path = os.path.join(args.dataset_image_path, img_name)
+            image = cv2.imread(img_path, cv2.IMREAD_COLOR)
+            if image is None:
+                skipped.append(img_path)
+                continue
+            out_dir = os.path.dirname(out_name)
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            np.save(out_name, cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        for img_path in skipped:
+            print('Can not read image %s, skipped' % img_path)
+
+    print('Done!')
+
+
+if __name__ == '__main__':
+    main()
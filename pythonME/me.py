@@ -37,13 +37,13 @@ class ME:
         self.estimator.InitME(width, height, self.pixel_precision, min_size_block, max_size_block, loss_metric.lower(),
                               max_len_hor, max_len_vert)
 
-    def EstimateME(self, current_frame, reference_frame, return_error=False):
+    def EstimateME(self, current_frame, reference_frame, return_error=False, stride=1):
         if not isinstance(current_frame, numpy.ndarray):
             current_frame = numpy.array(current_frame)
-        current_frame = current_frame.astype(numpy.uint8)
+        current_frame = numpy.ascontiguousarray(current_frame, dtype=numpy.uint8)
         if not isinstance(reference_frame, numpy.ndarray):
             reference_frame = numpy.array(reference_frame)
-        reference_frame = reference_frame.astype(numpy.uint8)
+        reference_frame = numpy.ascontiguousarray(reference_frame, dtype=numpy.uint8)
         assert current_frame.shape == (
         self.height, self.width, 3), "current_frame.shape must be equal ({}, {}, 3)! current_frame.shape = {}".format(
             self.height, self.width, current_frame.shape)
@@ -51,14 +51,18 @@ class ME:
                                          3), "reference_frame.shape must be equal ({}, {}, 3)! reference_frame.shape = {}".format(
             self.height, self.width, reference_frame.shape)
         # check images sizes
-        result = self.estimator.EstimateME(current_frame, reference_frame).copy()
+        # keep every stride-th vector only (stride=4 gives one vector per min 4x4 block)
+        result = self.estimator.EstimateME(current_frame, reference_frame)[::stride, ::stride]
+        width, height = result.shape[:2]
+        # write the scaled vectors straight into a single (2, height, width) float32 array
+        out = numpy.empty((2, height, width), dtype=numpy.float32)
+        numpy.true_divide(numpy.transpose(result[:, :, 0], axes=[1, 0]), self.pixel_precision, out=out[0])
+        numpy.true_divide(numpy.transpose(result[:, :, 1], axes=[1, 0]), self.pixel_precision, out=out[1])
         if return_error:
-            return (numpy.transpose(result[:, :, 0] / self.pixel_precision, axes=[1, 0]).reshape(self.height, self.width),
-                    numpy.transpose(result[:, :, 1] / self.pixel_precision, axes=[1, 0]).reshape(self.height, self.width),
-                    numpy.transpose(result[:, :, 2], axes=[1, 0]).reshape(self.height, self.width))
+            return out[0], out[1], numpy.transpose(result[:, :, 2], axes=[1, 0]).copy()
         else:
-            return (numpy.transpose(result[:, :, 0] / self.pixel_precision, axes=[1, 0]).reshape(self.height, self.width),
-                    numpy.transpose(result[:, :, 1] / self.pixel_precision, axes=[1, 0]).reshape(self.height, self.width))
+            # (2, height, width) ndarray; still unpacks as (mv_x, mv_y)
+            return out
 
     def __del__(self):
         if not self.estimator is None:
@@ -1,4 +1,6 @@
+import os
 import numpy as np
+import cv2
 from pythonME.me import ME
 
 class MEHandler(object):
@@ -10,18 +12,67 @@ class MEHandler(object):
         self.L2R_ME = ME(W, H, loss_metric=loss_metric)
         self.R2L_ME = ME(W, H, loss_metric=loss_metric)
 
-    def warmed_up_me(self, MEInstance, cur_img, ref_img):
+    def warmed_up_me(self, MEInstance, cur_img, ref_img, stride=1):
+        # pyME appears to seed its search with candidates from the previous call (AddCandidatesFromPrvFrame),
+        # so extra runs on the same pair refine the result
         for _ in range(self.runs_to_warm_up - 1):
-            MEInstance.EstimateME(cur_img, ref_img)
-        return MEInstance.EstimateME(cur_img, ref_img)
+            MEInstance.EstimateME(cur_img, ref_img, stride=stride)
+        return MEInstance.EstimateME(cur_img, ref_img, stride=stride)
 
     def calculate_disparity(self, img_l, img_r):
         # img_l, img_r - images (HxWx3) shape. H and W must be a multiple of 16. 
         # return - tuple of 2 tensors of (2, H//4, W//4) shape -- Motion Vectors from img_l to img_r and back. # div by 4 because of 4x4 min MB size
-        l2r = np.asarray(self.warmed_up_me(self.L2R_ME, img_l, img_r))
-        r2l = np.asarray(self.warmed_up_me(self.R2L_ME, img_r, img_l))
+        l2r = self.warmed_up_me(self.L2R_ME, img_l, img_r, stride=4)
+        r2l = self.warmed_up_me(self.R2L_ME, img_r, img_l, stride=4)
 
-        return l2r[..., ::4, ::4], r2l[..., ::4, ::4]
+        return l2r, r2l
+
+
+class CUDAMEHandler(object):
+    # Same interface as MEHandler, but Motion Vectors are dense Farneback optical flow computed with OpenCV CUDA.
+    # NB: this is a different input signal than pyME block MVs (smooth, dense, not quarter-pel),
+    # models trained on pyME MVs are not interchangeable with it.
+    # cv2.cuda can not be used in forked DataLoader workers, so it must run in the main process (num_workers=0).
+    def __init__(self, H, W, loss_metric=None, runs_to_warm_up=1):
+        from torch.utils.data import get_worker_info
+        if get_worker_info() is not None:
+            raise RuntimeError('CUDAMEHandler (ME_BACKEND=cuda) can not run inside DataLoader workers, use num_workers=0')
+        self.W = W
+        self.H = H
+        self.loss_metric = loss_metric # unused, kept for MEHandler compatibility
+        self.runs_to_warm_up = runs_to_warm_up
+        self.optical_flow = cv2.cuda_FarnebackOpticalFlow.create()
+        self.gpu_l = cv2.cuda_GpuMat()
+        self.gpu_r = cv2.cuda_GpuMat()
+        self.warm_up()
+
+    def warm_up(self):
+        dummy = np.zeros((self.H, self.W, 3), dtype=np.uint8)
+        for _ in range(self.runs_to_warm_up - 1):
+            self.calculate_disparity(dummy, dummy)
+
+    def flow_to_mv(self, flow):
+        # HxWx2 flow (x, y in pixels) -> (2, H//4, W//4) like pyME with 4x4 min MB size
+        return np.ascontiguousarray(flow[::4, ::4].transpose(2, 0, 1))
+
+    def calculate_disparity(self, img_l, img_r):
+        # img_l, img_r - RGB images (HxWx3) shape
+        # return - tuple of 2 arrays of (2, H//4, W//4) shape -- flow from img_l to img_r and back
+        self.gpu_l.upload(np.ascontiguousarray(img_l))
+        self.gpu_r.upload(np.ascontiguousarray(img_r))
+        gray_l = cv2.cuda.cvtColor(self.gpu_l, cv2.COLOR_RGB2GRAY)
+        gray_r = cv2.cuda.cvtColor(self.gpu_r, cv2.COLOR_RGB2GRAY)
+        l2r = self.optical_flow.calc(gray_l, gray_r, None).download()
+        r2l = self.optical_flow.calc(gray_r, gray_l, None).download()
+
+        return self.flow_to_mv(l2r), self.flow_to_mv(r2l)
+
+
+def create_me_handler(H, W, loss_metric, runs_to_warm_up=2):
+    # ME_BACKEND=cuda switches from pyME block matching (CPU) to OpenCV CUDA optical flow
+    if os.environ.get('ME_BACKEND', 'cpu').lower() == 'cuda':
+        return CUDAMEHandler(H, W, loss_metric, runs_to_warm_up)
+    return MEHandler(H, W, loss_metric, runs_to_warm_up)
 
 ### Code from https://stackoverflow.com/questions/34152758/how-to-deepcopy-when-pickling-is-not-possible
 ### Allow torch.Dataloader to pickle MEHandler (instanses of pyME)
@@ -32,5 +83,10 @@ def pickle_ME(me):
     return MEHandler, (me.H, me.W, me.loss_metric, me.runs_to_warm_up)
 
 copyreg.pickle(MEHandler, pickle_ME)
+
+def pickle_CUDAME(me):
+    return CUDAMEHandler, (me.H, me.W, me.loss_metric, me.runs_to_warm_up)
+
+copyreg.pickle(CUDAMEHandler, pickle_CUDAME)
 #
 ###
\ No newline at end of file
@@ -23,7 +23,7 @@ from image.normalization import NormalizeImageDict
 
 from util.train_test_fn import train, validate_model
 from util.eval_util import compute_metric
-from util.torch_util import save_checkpoint, str_to_bool, BatchTensorToVars
+from util.torch_util import save_checkpoint, str_to_bool, BatchTensorToVars, MV_QUANT_SCALE
 
 from options.options import ArgumentParser
 
@@ -35,6 +35,48 @@ on the PF/PF-pascal/Caltech-101 and TSS datasets
 
 """
 
+class CUDAPrefetcher(object):
+    """
+    
+    Wraps a DataLoader and copies the next batch to the GPU on a side CUDA stream
+    while the current batch is being processed
+    
+    Args:
+            dataloader (DataLoader): loader yielding dict batches (should use pin_memory=True).
+            device (torch.device): CUDA device to copy batches to.
+            
+    """
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return {key: value.to(self.device, non_blocking=True) if isinstance(value, torch.Tensor) else value
+                    for key, value in batch.items()}
+
+    def __iter__(self):
+        loader_iter = iter(self.dataloader)
+        next_batch = self.preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            # tensors were allocated on the side stream, mark them as used by the compute stream
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    value.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(loader_iter)
+            yield batch
+
+
 def load_checkpoint(checkpoint_filename, model, optimizer, device):
     if os.path.exists(checkpoint_filename):
         checkpoint = torch.load(checkpoint_filename, map_location=device)
@@ -121,7 +163,8 @@ def main():
                         use_conf=args.use_conf, 
                         use_random_patch=args.use_random_patch,
                         normalize_inputs=args.normalize_inputs,
-                        random_sample=args.random_sample)
+                        random_sample=args.random_sample,
+                        quantize_mv=args.quantize_mv)
 
         dataset_val = MEDataset(geometric_model=args.geometric_model, 
                         dataset_csv_path=args.dataset_csv_path, 
@@ -132,7 +175,8 @@ def main():
                         use_conf=args.use_conf, 
                         use_random_patch=args.use_random_patch,
                         normalize_inputs=args.normalize_inputs,
-                        random_sample=args.random_sample)
+                        random_sample=args.random_sample,
+                        quantize_mv=args.quantize_mv)
 
     else:
 
@@ -152,7 +196,8 @@ def main():
 
     # Set Tnf pair generation func
     if use_me:
-        pair_generation_tnf = BatchTensorToVars(use_cuda=use_cuda)
+        pair_generation_tnf = BatchTensorToVars(use_cuda=use_cuda,
+                                                mv_scale=MV_QUANT_SCALE if args.quantize_mv else None)
     elif args.geometric_model == 'affine_simple' or args.geometric_model == 'affine_simple_4':
         pair_generation_tnf = SynthPairTnf(geometric_model='affine',
 				       use_cuda=use_cuda)
@@ -160,11 +205,23 @@ def main():
         raise NotImplementedError('Specified geometric model is unsupported')
 
     # Initialize DataLoaders
+    # pinned memory allows async H2D copies; persistent workers keep their dataset copy (and ME) between epochs
     dataloader = DataLoader(dataset, batch_size=args.batch_size,
-                            shuffle=True, num_workers=4)
+                            shuffle=True, num_workers=args.num_workers,
+                            pin_memory=use_cuda, persistent_workers=args.num_workers > 0)
 
+    # validation loss does not depend on order; sequential reads keep OS read-ahead/page cache effective
     dataloader_val = DataLoader(dataset_val, batch_size=args.batch_size,
-                                shuffle=True, num_workers=4)
+                                shuffle=False, num_workers=args.num_workers,
+                                pin_memory=use_cuda, persistent_workers=args.num_workers > 0)
+
+    # overlap H2D copy of the next batch with compute on the current one
+    if use_cuda:
+        batch_loader = CUDAPrefetcher(dataloader, device)
+        batch_loader_val = CUDAPrefetcher(dataloader_val, device)
+    else:
+        batch_loader = dataloader
+        batch_loader_val = dataloader_val
 
     # Optimizer
     optimizer = optim.Adam(model.FeatureRegression.parameters(), lr=args.lr)
@@ -187,24 +244,29 @@ def main():
 
     logs_writer = SummaryWriter(tb_dir)
     # add graph, to do so we have to generate a dummy input to pass along with the graph
-    if use_me:
-        dummy_input = {
-            'mv_L2R': torch.rand([args.batch_size, 2, 216, 384], device = device),
-            'mv_R2L': torch.rand([args.batch_size, 2, 216, 384], device = device),
-            'grid_L2R': torch.rand([args.batch_size, 2, 216, 384], device = device),
-            'grid_R2L': torch.rand([args.batch_size, 2, 216, 384], device = device),
-            'grid': torch.rand([args.batch_size, 2, 216, 384], device = device),
-            'conf_L': torch.rand([args.batch_size, 1, 216, 384], device = device),
-            'conf_R': torch.rand([args.batch_size, 1, 216, 384], device = device),
-            'theta_GT': torch.rand([args.batch_size, 4], device = device),
-        }
-
-    else:
-        dummy_input = {'source_image': torch.rand([args.batch_size, 3, 240, 240], device = device),
-                       'target_image': torch.rand([args.batch_size, 3, 240, 240], device = device),
-                       'theta_GT': torch.rand([args.batch_size, 2, 3], device = device)}
-
-    logs_writer.add_graph(model, dummy_input)
+    # (batch of 1 is enough for tracing; the model lives on device, so the input has to as well)
+    if args.log_graph:
+        if use_me:
+            dummy_input = {
+                'mv_L2R': torch.rand([1, 2, 216, 384], device = device),
+                'mv_R2L': torch.rand([1, 2, 216, 384], device = device),
+                'grid_L2R': torch.rand([1, 2, 216, 384], device = device),
+                'grid_R2L': torch.rand([1, 2, 216, 384], device = device),
+                'grid': torch.rand([1, 2, 216, 384], device = device),
+                'conf_L': torch.rand([1, 1, 216, 384], device = device),
+                'conf_R': torch.rand([1, 1, 216, 384], device = device),
+                'theta_GT': torch.rand([1, 4], device = device),
+            }
+
+        else:
+            dummy_input = {'source_image': torch.rand([1, 3, 240, 240], device = device),
+                           'target_image': torch.rand([1, 3, 240, 240], device = device),
+                           'theta_GT': torch.rand([1, 2, 3], device = device)}
+
+        logs_writer.add_graph(model, dummy_input)
+        del dummy_input
+        if use_cuda:
+            torch.cuda.empty_cache()
 
     # Start of training
     print('Starting training...')
@@ -254,7 +316,7 @@ def main():
 
         # we don't need the average epoch loss so we assign it to _
         _ = train(epoch, model, loss, optimizer,
-                  dataloader, pair_generation_tnf,
+                  batch_loader, pair_generation_tnf,
                   log_interval=args.log_interval,
                   scheduler=scheduler,
                   is_cosine_scheduler=is_cosine_scheduler,
@@ -266,7 +328,7 @@ def main():
             scheduler.step()
 
         val_loss = validate_model(model, loss,
-                                  dataloader_val, pair_generation_tnf,
+                                  batch_loader_val, pair_generation_tnf,
                                   epoch, logs_writer)
 
         # Change lr_max in cosine annealing
@@ -1,14 +1,26 @@
 import shutil
+import numpy as np
 import torch
 from torch.autograd import Variable
 from os import makedirs, remove
 from os.path import exists, join, basename, dirname
 
+# Fixed-point scale for quantized Motion Vectors: 1 int16 unit = 1/4 pel (pyME QuarterPixel precision)
+MV_QUANT_SCALE = 4
+
+def mv_to_int16(mv):
+    # float MVs in pels -> int16 in 1/MV_QUANT_SCALE pel units (half the bytes of float32).
+    # Lossless only for pyME output; other vectors (.npz files, CUDA optical flow) are rounded to 1/4 pel.
+    return np.rint(np.asarray(mv) * MV_QUANT_SCALE).astype(np.int16)
+
 class BatchTensorToVars(object):
     """Convert tensors in dict batch to vars
+       If mv_scale is set, quantized tensors under mv_keys are cast to float and divided by it after the device copy
     """
-    def __init__(self, use_cuda=True):
+    def __init__(self, use_cuda=True, mv_scale=None, mv_keys=('mv_L2R', 'mv_R2L')):
         self.use_cuda=use_cuda
+        self.mv_scale=mv_scale
+        self.mv_keys=mv_keys
         
     def __call__(self, batch):
         batch_var = {}
@@ -16,9 +28,11 @@ class BatchTensorToVars(object):
             if isinstance(value,torch.Tensor) and not self.use_cuda:
                 batch_var[key] = Variable(value,requires_grad=False)
             elif isinstance(value,torch.Tensor) and self.use_cuda:
-                batch_var[key] = Variable(value,requires_grad=False).cuda()
+                batch_var[key] = Variable(value,requires_grad=False).cuda(non_blocking=True)
             else:
                 batch_var[key] = value            
+            if self.mv_scale is not None and key in self.mv_keys and not value.is_floating_point():
+                batch_var[key] = batch_var[key].float() / self.mv_scale
         return batch_var
     
 def save_checkpoint(state, is_best, file):